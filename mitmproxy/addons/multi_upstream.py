@@ -6,35 +6,61 @@ from a directory and dynamically selecting the appropriate upstream proxy
 based on rules defined in configuration files.
 """
 
+import base64
 import json
 import logging
+import os
 import random
 import re
-import base64
+import urllib.parse
+from collections import OrderedDict
 from dataclasses import dataclass
+from dataclasses import field
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
 import yaml
-import urllib.parse
 
+from mitmproxy import connection
 from mitmproxy import ctx
 from mitmproxy import http
-from mitmproxy.net import server_spec
 from mitmproxy.proxy.mode_specs import MultiUpstreamMode
+from mitmproxy.proxy.mode_specs import ProxyMode
 from mitmproxy.utils import strutils
 
+# Prefer the libyaml parser, which is much faster on large rule sets.
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
-@dataclass
+_WILDCARD_TRANSLATE = {
+    **{i: "\\" + chr(i) for i in b"()[]{}?+-|^$\\.&~# \t\n\r\v\f"},
+    ord("*"): ".*",
+}
+"""str.translate table escaping the same characters as re.escape, with `*` as the wildcard."""
+
+
+@dataclass(slots=True)
 class ProxyRule:
     """Represents a rule for proxy selection."""
     type: str
     pattern: Optional[str] = None
     port: Optional[int] = None
     value: Optional[Any] = None
+    compiled: Optional[re.Pattern] = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Translate the wildcard pattern once instead of on every flow.
+        # Host names are case-insensitive, and so are host patterns.
+        if self.type == 'host_pattern' and self.pattern and self.compiled is None:
+            self.compiled = re.compile(self.pattern.translate(_WILDCARD_TRANSLATE), re.IGNORECASE)
 
 
-@dataclass
+@dataclass(slots=True)
 class ProxyConfig:
     """Represents a proxy configuration."""
     name: str
@@ -43,160 +69,393 @@ class ProxyConfig:
     rules: List[ProxyRule] = None
     username: Optional[str] = None
     password: Optional[str] = None
+    # Derived from url/username/password once, so flows don't re-parse them.
+    scheme: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    address: Optional[Tuple[str, int]] = field(default=None, init=False, repr=False, compare=False)
+    credentials: Optional[Tuple[str, str]] = field(default=None, init=False, repr=False, compare=False)
+    auth_header: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+    has_default_rule: bool = field(default=False, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         if self.rules is None:
             self.rules = []
 
+        self.has_default_rule = any(rule.type == 'default' for rule in self.rules)
+
+        try:
+            parsed_url = urllib.parse.urlparse(self.url)
+            host = parsed_url.hostname
+            scheme = parsed_url.scheme
+            if scheme == "socks5":
+                port = parsed_url.port or 1080  # Default SOCKS5 port
+            elif scheme == "https":
+                port = parsed_url.port or 443
+            else:  # http
+                port = parsed_url.port or 80
+        except ValueError as e:
+            logging.error(f"Error parsing proxy URL {self.url}: {e}")
+            return
+        if not scheme or not host:
+            return
+        self.scheme = scheme
+        self.address = (host, port)
+
+        # Credentials embedded in the URL take precedence over the separate fields.
+        if parsed_url.username and parsed_url.password:
+            self.credentials = (
+                urllib.parse.unquote(parsed_url.username),
+                urllib.parse.unquote(parsed_url.password),
+            )
+        elif self.username and self.password:
+            self.credentials = (self.username, self.password)
+
+        if self.credentials:
+            auth_bytes = strutils.always_bytes(":".join(self.credentials))
+            self.auth_header = b"Basic " + base64.b64encode(auth_bytes)
+
+
+_UNIFORM = object()
+"""Marker alias table for groups where every proxy has the same weight."""
+
+
+def _build_alias_table(weights: List[int]) -> Any:
+    """
+    Build Vose alias tables (prob, alias) for the given weights.
+
+    Returns `_UNIFORM` if all weights are equal, in which case a plain
+    uniform pick is both cheaper and exact.
+    """
+    n = len(weights)
+    total = sum(weights)
+    if total <= 0 or len(set(weights)) == 1:
+        return _UNIFORM
+
+    prob = [0.0] * n
+    alias = [0] * n
+    scaled = [w * n / total for w in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        g = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = g
+        scaled[g] = scaled[g] + scaled[s] - 1.0
+        if scaled[g] < 1.0:
+            small.append(g)
+        else:
+            large.append(g)
+    # Whatever is left over is (up to rounding errors) exactly full.
+    for i in large + small:
+        prob[i] = 1.0
+    return prob, alias
+
+
+_DECISION_CACHE_SIZE = 1024
+"""Maximum number of (host, port) pairs for which the matching proxies are memoized."""
+
+_SESSION_AFFINITY_SIZE = 4096
+"""Maximum number of connections for which the selected proxy is remembered."""
+
+_TERMINAL = object()
+"""Key under which a suffix trie node stores the proxies whose pattern ends there."""
+
+
+class _RuleIndex:
+    """
+    Lookup structures over the rules of all rule-based proxies, so that finding
+    the candidates for a flow does not require evaluating every single rule.
+
+    Proxies are referred to by their position in the proxy list.
+    """
+
+    def __init__(self, proxies: List[ProxyConfig]):
+        self.exact_hosts: Dict[str, List[int]] = {}
+        # Nested dicts over reversed host labels, e.g. "*.example.com" is stored
+        # at suffix_trie["com"]["example"][_TERMINAL].
+        self.suffix_trie: Dict[Any, Any] = {}
+        self.ports: Dict[int, List[int]] = {}
+        self.patterns: List[Tuple[re.Pattern, int]] = []
+        self.always: List[int] = []
+
+        for i, proxy in enumerate(proxies):
+            for rule in proxy.rules:
+                if rule.type == 'host_pattern' and rule.pattern and rule.compiled is not None:
+                    self._add_host_pattern(rule.pattern.lower(), rule.compiled, i)
+                elif rule.type == 'port' and rule.port:
+                    self.ports.setdefault(rule.port, []).append(i)
+                elif rule.type == 'default':
+                    self.always.append(i)
+
+    def _add_host_pattern(self, pattern: str, compiled: re.Pattern, i: int) -> None:
+        if '*' not in pattern:
+            self.exact_hosts.setdefault(pattern, []).append(i)
+            return
+        labels = pattern[2:].split('.')
+        if pattern.startswith('*.') and '*' not in pattern[2:] and all(labels):
+            node = self.suffix_trie
+            for label in reversed(labels):
+                node = node.setdefault(label, {})
+            node.setdefault(_TERMINAL, []).append(i)
+        else:
+            self.patterns.append((compiled, i))
+
+    def lookup(self, host: Optional[str], port: Optional[int]) -> Set[int]:
+        """
+        Return the positions of the proxies whose rules match host or port.
+        `host` must already be lowercase.
+
+        Exact host rules and then port rules pin a request: if any proxy has one
+        that matches, only those proxies are returned. An exact host is the most
+        specific rule there is, so it wins over a port rule such as a catch-all
+        for 443. Otherwise, all proxies with a matching wildcard pattern or a
+        default rule are returned, and weighted selection spreads the request
+        across all of them.
+        """
+        if isinstance(host, str):
+            exact_hits = self.exact_hosts.get(host)
+            if exact_hits:
+                return set(exact_hits)
+        if port is not None:
+            port_hits = self.ports.get(port)
+            if port_hits:
+                return set(port_hits)
+        hits = set(self.always)
+        if isinstance(host, str):
+            labels = host.split('.')
+            node = self.suffix_trie
+            # Walk from the TLD inwards, but always leave at least one label for the "*".
+            for depth in range(len(labels) - 1, 0, -1):
+                child = node.get(labels[depth])
+                if child is None:
+                    break
+                node = child
+                hits.update(node.get(_TERMINAL, ()))
+            hits.update(
+                i for compiled, i in self.patterns if i not in hits and compiled.fullmatch(host)
+            )
+        return hits
+
 
 class MultiUpstreamAddon:
     """Addon for managing multiple upstream proxies in multi_upstream mode."""
 
     def __init__(self):
+        # Vose alias tables for weighted selection, keyed by the matching proxies
+        self._alias_cache: Dict[Tuple[int, ...], Any] = {}
+        # Our own generator, so that selection doesn't share the global random state
+        # and tests can seed it.
+        self._rng = random.Random()
+        # LRU of (host, port) -> matching rule-based proxies
+        self._decision_cache: OrderedDict[Tuple[Any, Any], Tuple[ProxyConfig, ...]] = OrderedDict()
+        # Session affinity mapping: connection_id -> proxy_config, as an LRU.
+        # websocket_end/client_disconnect don't fire for every connection,
+        # so the size cap is what keeps this from growing without bound.
+        self.session_affinity: OrderedDict[Tuple, ProxyConfig] = OrderedDict()
         self.proxy_configs: List[ProxyConfig] = []
+        # ((path, mtime_ns, size), proxy_configs, default_proxy) of the last file loaded
+        self._config_cache: Optional[Tuple[Tuple[Path, int, int], List[ProxyConfig], Optional[ProxyConfig]]] = None
         self.default_proxy: Optional[ProxyConfig] = None
         self.config_loaded = False
-        # Session affinity mapping: connection_id -> proxy_config
-        self.session_affinity: Dict[str, ProxyConfig] = {}
+
+    @property
+    def proxy_configs(self) -> List[ProxyConfig]:
+        """The rule-based proxies. Assigning to this rebuilds the rule index and resets all selection state."""
+        return self._proxy_configs
+
+    @proxy_configs.setter
+    def proxy_configs(self, proxy_configs: List[ProxyConfig]) -> None:
+        self._proxy_configs = proxy_configs
+        self._rule_index = _RuleIndex(proxy_configs)
+        self._alias_cache.clear()
+        self._decision_cache.clear()
+        # Affinity hits are served before the index is consulted, and may refer to removed proxies.
+        self.session_affinity.clear()
 
     def load(self, loader):
         pass
 
     def configure(self, updated):
         if "mode" in updated:
-            try:
-                config_dir = ctx.options.mode[0].split(":", 1)[1]
-                self._load_configuration_from_dir(config_dir)
-            except Exception as e:
-                logging.error(f"Error in configure: {e}")
-                raise
+            for spec in ctx.options.mode:
+                # Only parse our own specs; the proxyserver addon validates the rest.
+                if spec.partition(":")[0].lower() != MultiUpstreamMode.type_name:
+                    continue
+                self._load_configuration_from_dir(ProxyMode.parse(spec).data)
+                break
 
     def _load_configuration_from_dir(self, config_dir: str) -> None:
-        try:
-            logging.info(f"Loading configuration from directory: {config_dir}")
-            config_path = Path(config_dir)
-            if not config_path.exists():
-                logging.warning(f"Configuration directory {config_dir} does not exist")
-                return
+        logging.info(f"Loading configuration from directory: {config_dir}")
+        config_path = Path(config_dir)
+        if not config_path.exists():
+            logging.warning(f"Configuration directory {config_dir} does not exist")
+            return
+
+        if not config_path.is_dir():
+            logging.error(f"{config_dir} is not a directory")
+            return
 
-            if not config_path.is_dir():
-                logging.error(f"{config_dir} is not a directory")
-                return
+        # Look for configuration files in a single pass over the directory
+        try:
+            with os.scandir(config_path) as entries:
+                config_names = [
+                    entry.name for entry in entries
+                    if entry.name.endswith(('.yaml', '.yml', '.json')) and entry.is_file()
+                ]
+        except OSError as e:
+            logging.error(f"Error listing configuration directory {config_dir}: {e}")
+            return
 
+        if not config_names:
             self.proxy_configs = []
             self.default_proxy = None
+            logging.warning(f"No configuration files found in {config_dir}")
+            return
+
+        # Pick by priority: proxies.yaml first, then others by name
+        config_file = config_path / min(config_names, key=lambda name: (name != 'proxies.yaml', name))
+
+        # configure() reloads whenever the mode option is updated, e.g. when another mode
+        # is added, even if this file did not change; skip re-parsing it in that case.
+        try:
+            stat = config_file.stat()
+            file_key = (config_file, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_key = None
+        if file_key is not None and self._config_cache is not None and self._config_cache[0] == file_key:
+            _, proxy_configs, default_proxy = self._config_cache
+            if self.proxy_configs is not proxy_configs:
+                self.proxy_configs = proxy_configs
+            self.default_proxy = default_proxy
+            self.config_loaded = True
+            return
+
+        self.proxy_configs = []
+        self.default_proxy = None
+        self._config_cache = None
+        logging.info(f"Loading configuration from {config_file}")
 
-            # Look for configuration files with priority
-            config_files = []
-            for ext in ['*.yaml', '*.yml', '*.json']:
-                config_files.extend(config_path.glob(ext))
-
-            if not config_files:
-                logging.warning(f"No configuration files found in {config_dir}")
-                return
-
-            # Sort config files by priority: proxies.yaml first, then others
-            config_files.sort(key=lambda x: (x.name != 'proxies.yaml', x.name))
-            config_file = config_files[0]
-            logging.info(f"Loading configuration from {config_file}")
-
-            try:
-                with open(config_file, 'r', encoding='utf-8') as f:
-                    if config_file.suffix == '.json':
-                        config = json.load(f)
-                    else:
-                        config = yaml.safe_load(f)
-
-                if 'proxies' not in config:
-                    logging.error("No 'proxies' section found in configuration file")
-                    return
-
-                for proxy_data in config['proxies']:
-                    rules = []
-                    for rule_data in proxy_data.get('rules', []):
-                        rule = ProxyRule(
-                            type=rule_data['type'],
-                            pattern=rule_data.get('pattern'),
-                            port=rule_data.get('port'),
-                            value=rule_data.get('value')
-                        )
-                        rules.append(rule)
-
-                    proxy_config = ProxyConfig(
-                        name=proxy_data['name'],
-                        url=proxy_data['url'],
-                        weight=proxy_data.get('weight', 1),
-                        rules=rules,
-                        username=proxy_data.get('username'),
-                        password=proxy_data.get('password')
-                    )
-
-                    # Check if this is the default proxy
-                    if any(rule.type == 'default' for rule in rules):
-                        self.default_proxy = proxy_config
-                    else:
-                        self.proxy_configs.append(proxy_config)
-
-                logging.info(f"Loaded {len(self.proxy_configs)} proxy configurations from {config_file}")
-                if self.default_proxy:
-                    logging.info(f"Default proxy: {self.default_proxy.name}")
-
-                self.config_loaded = True
-
-            except Exception as e:
-                logging.error(f"Error loading configuration from {config_file}: {e}")
-        except Exception as e:
-            logging.error(f"Error in _load_configuration_from_dir: {e}")
-            raise
+        try:
+            text = config_file.read_text(encoding='utf-8')
+            parsed = self._parse_config_text(text, config_file.suffix)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, yaml.YAMLError) as e:
+            logging.error(f"Error loading configuration from {config_file}: {e}")
+            return
+        if parsed is None:
+            logging.error("No 'proxies' section found in configuration file")
+            return
+        proxy_configs, default_proxy = parsed
+
+        self.proxy_configs = proxy_configs
+        self.default_proxy = default_proxy
+        if file_key is not None:
+            self._config_cache = (file_key, proxy_configs, default_proxy)
+
+        logging.info(f"Loaded {len(self.proxy_configs)} proxy configurations from {config_file}")
+        if self.default_proxy:
+            logging.info(f"Default proxy: {self.default_proxy.name}")
+
+        self.config_loaded = True
+
+    @staticmethod
+    def _parse_config_text(
+        text: str, suffix: str
+    ) -> Optional[Tuple[List[ProxyConfig], Optional[ProxyConfig]]]:
+        """
+        Parse the contents of a configuration file into (rule-based proxies, default proxy).
+
+        `suffix` is the file extension and selects between JSON and YAML. Returns None if there
+        is no 'proxies' section. Malformed input raises ValueError, KeyError, TypeError,
+        AttributeError or yaml.YAMLError.
+        """
+        if suffix == '.json':
+            config = json.loads(text)
+        else:
+            config = yaml.load(text, Loader=SafeLoader)
+
+        if not isinstance(config, dict) or 'proxies' not in config:
+            return None
+
+        default_proxy = None
+        proxy_configs = []
+        for proxy_data in config['proxies']:
+            rules = []
+            for rule_data in proxy_data.get('rules', []):
+                rule = ProxyRule(
+                    type=rule_data['type'],
+                    pattern=rule_data.get('pattern'),
+                    port=rule_data.get('port'),
+                    value=rule_data.get('value')
+                )
+                rules.append(rule)
+
+            proxy_config = ProxyConfig(
+                name=proxy_data['name'],
+                url=proxy_data['url'],
+                weight=proxy_data.get('weight', 1),
+                rules=rules,
+                username=proxy_data.get('username'),
+                password=proxy_data.get('password')
+            )
+
+            # Check if this is the default proxy
+            if proxy_config.has_default_rule:
+                default_proxy = proxy_config
+            else:
+                proxy_configs.append(proxy_config)
+        return proxy_configs, default_proxy
 
     def _matches_rule(self, flow: http.HTTPFlow, rule: ProxyRule) -> bool:
         """Check if a flow matches a specific rule."""
+        return self._rule_matches(rule, flow.request.pretty_host, flow.request.port)
+
+    @staticmethod
+    def _rule_matches(rule: ProxyRule, host: str, port: int) -> bool:
+        """Check if a request for host and port matches a specific rule."""
         if rule.type == 'host_pattern':
-            if rule.pattern:
-                # 支持通配符 *，自动转为正则 .*
-                pattern = re.escape(rule.pattern).replace(r'\*', '.*')
-                host = getattr(flow.request, 'pretty_host', None) or getattr(flow.request, 'host', None)
-                if not isinstance(host, str):
-                    return False
-                return re.search(pattern, host) is not None
+            return rule.compiled is not None and rule.compiled.fullmatch(host) is not None
         elif rule.type == 'port':
-            if rule.port and getattr(flow.request, 'port', None) == rule.port:
-                return True
+            return bool(rule.port) and port == rule.port
         elif rule.type == 'default':
             return True
         return False
 
-    def _get_connection_id(self, flow: http.HTTPFlow) -> str:
+    def _get_connection_id(self, flow: http.HTTPFlow) -> Tuple:
         """Generate a unique connection identifier for session affinity."""
         # For WebSocket connections, use client address + target host
         if hasattr(flow, 'websocket') and flow.websocket:
-            return f"{flow.client_conn.address[0]}:{flow.request.pretty_host}"
+            return (flow.client_conn.peername[0], flow.request.pretty_host)
         # For regular HTTP, use client address + target host + port
-        return f"{flow.client_conn.address[0]}:{flow.request.pretty_host}:{flow.request.port}"
+        return (flow.client_conn.peername[0], flow.request.pretty_host, flow.request.port)
 
     def _select_proxy(self, flow: http.HTTPFlow) -> Optional[ProxyConfig]:
         """Select the appropriate proxy based on rules with session affinity."""
         if not self.config_loaded:
             return None
+        if not self.proxy_configs:
+            # Nothing but the default proxy: the answer is the same for every
+            # flow, so there is no need to track session affinity.
+            return self.default_proxy
+
+        host = flow.request.pretty_host.lower()
+        port = flow.request.port
+
+        matching_proxies = self._matching_proxies(host, port)
 
         # Check session affinity first
         connection_id = self._get_connection_id(flow)
-        if connection_id in self.session_affinity:
-            cached_proxy = self.session_affinity[connection_id]
-            # Verify the cached proxy still matches the rules
-            if self._proxy_matches_rules(cached_proxy, flow):
+        cached_proxy = self.session_affinity.get(connection_id)
+        if cached_proxy is not None:
+            # Verify the cached proxy is still a candidate for this request
+            if any(proxy is cached_proxy for proxy in matching_proxies) or (
+                not matching_proxies and cached_proxy is self.default_proxy
+            ):
+                self.session_affinity.move_to_end(connection_id)
                 return cached_proxy
             else:
                 # Remove invalid cached proxy
                 del self.session_affinity[connection_id]
 
-        matching_proxies = []
-
-        # Check all proxy configurations
-        for proxy_config in self.proxy_configs:
-            if self._proxy_matches_rules(proxy_config, flow):
-                matching_proxies.append(proxy_config)
-
         if not matching_proxies:
             # Use default proxy if no rules match
             if self.default_proxy:
@@ -206,71 +465,74 @@ class MultiUpstreamAddon:
         else:
             # If multiple proxies match, use weighted random selection
             if len(matching_proxies) > 1:
-                total_weight = sum(proxy.weight for proxy in matching_proxies)
-                weights = [proxy.weight / total_weight for proxy in matching_proxies]
-                selected_proxy = random.choices(matching_proxies, weights=weights)[0]
+                selected_proxy = self._weighted_choice(matching_proxies)
             else:
                 selected_proxy = matching_proxies[0]
 
         # Cache the selected proxy for session affinity
         self.session_affinity[connection_id] = selected_proxy
+        if len(self.session_affinity) > _SESSION_AFFINITY_SIZE:
+            self.session_affinity.popitem(last=False)
         return selected_proxy
 
-    def _proxy_matches_rules(self, proxy_config: ProxyConfig, flow: http.HTTPFlow) -> bool:
-        """Check if a proxy configuration matches the flow based on its rules."""
-        for rule in proxy_config.rules:
-            if self._matches_rule(flow, rule):
-                return True
-        return False
-
-    def proxy_address(self, flow: http.HTTPFlow) -> Optional[Tuple[str, Tuple[str, int]]]:
-        """Set the upstream proxy for the flow."""
+    def _matching_proxies(self, host: str, port: int) -> Tuple[ProxyConfig, ...]:
+        """Return the rule-based proxies matching host and port, memoized per (host, port)."""
+        key = (host, port)
+        cache = self._decision_cache
+        matching = cache.get(key)
+        if matching is not None:
+            cache.move_to_end(key)
+            return matching
+        matching = tuple(
+            self.proxy_configs[i] for i in sorted(self._rule_index.lookup(host, port))
+        )
+        cache[key] = matching
+        if len(cache) > _DECISION_CACHE_SIZE:
+            cache.popitem(last=False)
+        return matching
+
+    def _weighted_choice(self, proxies: Tuple[ProxyConfig, ...]) -> ProxyConfig:
+        """Pick one of the given proxies according to their weights in O(1)."""
+        key = tuple(id(proxy) for proxy in proxies)
+        table = self._alias_cache.get(key)
+        if table is None:
+            table = _build_alias_table([proxy.weight for proxy in proxies])
+            self._alias_cache[key] = table
+        if table is _UNIFORM:
+            return proxies[int(self._rng.random() * len(proxies))]
+        prob, alias = table
+        # A single draw yields both the column and the coin flip.
+        u = self._rng.random() * len(proxies)
+        i = int(u)
+        return proxies[i] if u - i < prob[i] else proxies[alias[i]]
+
+    def proxy_address(
+        self, flow: http.HTTPFlow, selected_proxy: Optional[ProxyConfig] = None
+    ) -> Optional[Tuple[str, Tuple[str, int]]]:
+        """
+        Set the upstream proxy for the flow.
+
+        Callers that have already run `_select_proxy` for this flow can pass the
+        result as `selected_proxy` to avoid selecting a second time.
+        """
         if not self.config_loaded:
             return None
 
-        selected_proxy = self._select_proxy(flow)
-        if selected_proxy:
-            try:
-                parsed_url = urllib.parse.urlparse(selected_proxy.url)
-                host = parsed_url.hostname
-                
-                # Handle different schemes
-                scheme = parsed_url.scheme
-                if scheme == "socks5":
-                    port = parsed_url.port or 1080  # Default SOCKS5 port
-                elif scheme == "https":
-                    port = parsed_url.port or 443
-                else:  # http
-                    port = parsed_url.port or 80
-                
-                address = (host, port)
-                if not scheme or not host or not port:
-                    return None
-                
-                # Extract authentication info from URL if present
-                username = None
-                password = None
-                if parsed_url.username and parsed_url.password:
-                    username = urllib.parse.unquote(parsed_url.username)
-                    password = urllib.parse.unquote(parsed_url.password)
-                elif selected_proxy.username and selected_proxy.password:
-                    # Fallback to separate username/password fields
-                    username = selected_proxy.username
-                    password = selected_proxy.password
-                
-                # Set authentication info in flow metadata for SOCKS5
-                if scheme == "socks5" and username and password:
-                    flow.metadata['socks5_username'] = username
-                    flow.metadata['socks5_password'] = password
-                
-                # Set the current upstream proxy information for compatibility
-                if hasattr(flow.server_conn, 'proxy_mode') and hasattr(flow.server_conn.proxy_mode, 'set_current_upstream'):
-                    flow.server_conn.proxy_mode.set_current_upstream(scheme, address)
-                return (scheme, address)
-            except Exception as e:
-                logging.error(f"Error parsing proxy URL {selected_proxy.url}: {e}")
-                return None
-        return None
+        if selected_proxy is None:
+            selected_proxy = self._select_proxy(flow)
+        if selected_proxy is None or selected_proxy.address is None:
+            return None
+
+        scheme = selected_proxy.scheme
+        address = selected_proxy.address
+
+        # Set authentication info in flow metadata for SOCKS5
+        if scheme == "socks5" and selected_proxy.credentials:
+            username, password = selected_proxy.credentials
+            flow.metadata['socks5_username'] = username
+            flow.metadata['socks5_password'] = password
+
+        return (scheme, address)
 
     def request(self, flow: http.HTTPFlow):
         """Handle HTTP request and set upstream proxy."""
@@ -278,13 +540,13 @@ class MultiUpstreamAddon:
         if not isinstance(flow.client_conn.proxy_mode, MultiUpstreamMode):
             return
         
-        proxy = self.proxy_address(flow)
+        selected_proxy = self._select_proxy(flow)
+        proxy = self.proxy_address(flow, selected_proxy)
         if proxy and len(proxy) == 2:
             scheme, address = proxy
             flow.server_conn.via = (scheme, address)
             
             # Add HTTP authentication if credentials are available
-            selected_proxy = self._select_proxy(flow)
             if selected_proxy and scheme in ["http", "https"]:
                 self._add_http_auth(flow, selected_proxy)
 
@@ -301,27 +563,8 @@ class MultiUpstreamAddon:
 
     def _add_http_auth(self, flow: http.HTTPFlow, proxy_config: ProxyConfig):
         """Add HTTP Basic authentication to the request."""
-        username = None
-        password = None
-        
-        # Try to get credentials from URL first
-        parsed_url = urllib.parse.urlparse(proxy_config.url)
-        if parsed_url.username and parsed_url.password:
-            username = urllib.parse.unquote(parsed_url.username)
-            password = urllib.parse.unquote(parsed_url.password)
-        elif proxy_config.username and proxy_config.password:
-            # Fallback to separate username/password fields
-            username = proxy_config.username
-            password = proxy_config.password
-        
-        if username and password:
-            # Create Basic auth header
-            auth_string = f"{username}:{password}"
-            auth_bytes = strutils.always_bytes(auth_string)
-            auth_header = b"Basic " + base64.b64encode(auth_bytes)
-            
-            # Add to request headers
-            flow.request.headers["Proxy-Authorization"] = auth_header
+        if proxy_config.auth_header:
+            flow.request.headers["Proxy-Authorization"] = proxy_config.auth_header
             logging.debug(f"Added HTTP authentication for proxy {proxy_config.name}")
 
     def websocket_start(self, flow: http.HTTPFlow):
@@ -337,15 +580,13 @@ class MultiUpstreamAddon:
 
     def websocket_end(self, flow: http.HTTPFlow):
         """Handle WebSocket connection end - cleanup session affinity."""
-        connection_id = self._get_connection_id(flow)
-        if connection_id in self.session_affinity:
-            del self.session_affinity[connection_id]
+        self.session_affinity.pop(self._get_connection_id(flow), None)
 
-    def client_disconnect(self, flow: http.HTTPFlow):
+    def client_disconnected(self, client: connection.Client):
         """Handle client disconnect - cleanup session affinity."""
-        connection_id = self._get_connection_id(flow)
-        if connection_id in self.session_affinity:
-            del self.session_affinity[connection_id]
-
-
-addons = [MultiUpstreamAddon()] 
\ No newline at end of file
+        # Affinity is keyed by client address, not by connection.
+        # The map is size-capped, so scanning it is bounded.
+        address = client.peername[0]
+        stale = [key for key in self.session_affinity if key[0] == address]
+        for key in stale:
+            del self.session_affinity[key]
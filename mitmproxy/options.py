@@ -156,6 +156,17 @@ class Options(optmanager.OptManager):
             True,
             "Include host header with CONNECT requests. Enabled by default.",
         )
+        self.add_option(
+            "socks5_optimistic_handshake",
+            bool,
+            False,
+            """
+            Send the SOCKS5 greeting, authentication and CONNECT request to upstream SOCKS5 proxies
+            in one go instead of waiting for each reply. This saves round trips, but the server must
+            accept pipelined handshakes, and with credentials only username/password authentication
+            is offered.
+            """,
+        )
         self.add_option(
             "websocket",
             bool,
@@ -1,15 +1,12 @@
 import socket
 import struct
-import time
-from logging import DEBUG
+from collections.abc import Callable
 
 from mitmproxy import connection
-from mitmproxy import http
 from mitmproxy.proxy import commands
 from mitmproxy.proxy import context
 from mitmproxy.proxy import layer
 from mitmproxy.proxy import tunnel
-from mitmproxy.proxy.layers import tls
 from mitmproxy.utils import human
 
 
@@ -34,25 +31,117 @@ SOCKS5_REP_TTL_EXPIRED = 0x06
 SOCKS5_REP_COMMAND_NOT_SUPPORTED = 0x07
 SOCKS5_REP_ADDRESS_TYPE_NOT_SUPPORTED = 0x08
 
+# Human-readable messages, indexed by reply code (0x00 to 0x08).
+_SOCKS5_REP_MESSAGES = (
+    "Succeeded",
+    "General failure",
+    "Connection not allowed",
+    "Network unreachable",
+    "Host unreachable",
+    "Connection refused",
+    "TTL expired",
+    "Command not supported",
+    "Address type not supported",
+)
+
+# The only greetings we ever send.
+_GREETING_NOAUTH = bytes((SOCKS5_VERSION, 1, SOCKS5_METHOD_NO_AUTHENTICATION_REQUIRED))
+_GREETING_AUTH_ONLY = bytes((SOCKS5_VERSION, 1, SOCKS5_METHOD_USER_PASSWORD_AUTHENTICATION))
+_GREETING_AUTH = bytes(
+    (
+        SOCKS5_VERSION,
+        2,
+        SOCKS5_METHOD_NO_AUTHENTICATION_REQUIRED,
+        SOCKS5_METHOD_USER_PASSWORD_AUTHENTICATION,
+    )
+)
+
+# VER | CMD | RSV of every CONNECT request.
+_CONNECT_PREFIX = bytes((SOCKS5_VERSION, SOCKS5_CMD_CONNECT, 0x00))
+
+# VER | REP | RSV of a successful CONNECT reply.
+_CONNECT_REPLY_OK = bytes((SOCKS5_VERSION, SOCKS5_REP_SUCCEEDED, 0x00))
+
+# Replies to a pipelined no-auth handshake: greeting (VER, METHOD) + CONNECT (VER, REP, RSV).
+_NOAUTH_CONNECT_OK = (
+    bytes((SOCKS5_VERSION, SOCKS5_METHOD_NO_AUTHENTICATION_REQUIRED)) + _CONNECT_REPLY_OK
+)
+# Total length of both replies by ATYP, for the address types with a fixed size.
+_NOAUTH_CONNECT_OK_LEN = {
+    SOCKS5_ATYP_IPV4_ADDRESS: len(_NOAUTH_CONNECT_OK) + 1 + 4 + 2,
+    SOCKS5_ATYP_IPV6_ADDRESS: len(_NOAUTH_CONNECT_OK) + 1 + 16 + 2,
+}
+
+# Fixed-size reply headers, unpacked in one call each.
+_HDR2 = struct.Struct("!BB").unpack_from
+_HDR4 = struct.Struct("!BBBB").unpack_from
+
+
+def _encode_address(host: str) -> tuple[int, bytes]:
+    """
+    Return the SOCKS5 address type and the encoded address for a host.
+
+    Most hosts are domain names, so we only try to parse IP literals if the host looks like one.
+    """
+    if ":" in host:
+        # IPv6 literals always contain a colon.
+        try:
+            return SOCKS5_ATYP_IPV6_ADDRESS, socket.inet_pton(socket.AF_INET6, host)
+        except OSError:
+            pass
+    elif host[:1].isdigit() and host.rpartition(".")[2].isdigit():
+        try:
+            return SOCKS5_ATYP_IPV4_ADDRESS, socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            pass
+    return SOCKS5_ATYP_DOMAINNAME, host.encode("ascii")
+
 
 class Socks5UpstreamProxy(tunnel.TunnelLayer):
     """SOCKS5 upstream proxy layer that implements SOCKS5 client protocol."""
     
-    buf: bytes
-    state: str
+    buf: bytearray
+    _pos: int
+    """Read cursor into buf; everything before it has already been consumed."""
+    _connect_need: int | None
+    """Length of the CONNECT reply, once its header has been parsed."""
+    state: Callable[[], layer.CommandGenerator[tuple[bool, str | None]]]
+    """The handler for the next expected reply."""
     conn: connection.Server
     tunnel_connection: connection.Server
     username: str | None
     password: str | None
+    _auth_payload: bytes | None
+    """The encoded username/password authentication request, if we have usable credentials."""
+    optimistic: bool
+    """
+    Whether the whole handshake is sent upfront (see the `socks5_optimistic_handshake` option)
+    instead of waiting for each reply before sending the next request.
+    """
 
     def __init__(
         self, ctx: context.Context, tunnel_conn: connection.Server, username: str | None = None, password: str | None = None
     ):
         super().__init__(ctx, tunnel_connection=tunnel_conn, conn=ctx.server)
-        self.buf = b""
-        self.state = "greet"
+        self.buf = bytearray()
+        self._pos = 0
+        self._connect_need = None
+        self.state = self._handle_greeting
         self.username = username
         self.password = password
+        self.optimistic = ctx.options.socks5_optimistic_handshake
+        self._auth_payload = None
+        if username and password:
+            user = username.encode("utf-8")
+            pw = password.encode("utf-8")
+            if len(user) <= 255 and len(pw) <= 255:
+                # version(1) + username_len(1) + username + password_len(1) + password
+                self._auth_payload = b"".join(
+                    (b"\x01", bytes((len(user),)), user, bytes((len(pw),)), pw)
+                )
+            else:
+                # We can't pipeline an authentication request we can't encode.
+                self.optimistic = False
 
     @classmethod
     def make(cls, ctx: context.Context, username: str | None = None, password: str | None = None) -> tunnel.LayerStack:
@@ -70,212 +159,180 @@ class Socks5UpstreamProxy(tunnel.TunnelLayer):
 
     def start_handshake(self) -> layer.CommandGenerator[None]:
         """Start SOCKS5 handshake by sending greeting."""
-        # Determine authentication method
-        if self.username and self.password:
-            # Send greeting with username/password authentication
-            greeting = bytes([
-                SOCKS5_VERSION,  # SOCKS version 5
-                2,               # Number of methods
-                SOCKS5_METHOD_NO_AUTHENTICATION_REQUIRED,  # No authentication required
-                SOCKS5_METHOD_USER_PASSWORD_AUTHENTICATION  # Username/password authentication
-            ])
+        has_credentials = bool(self.username and self.password)
+        if self.optimistic:
+            # Pipeline everything. With credentials we must only offer username/password
+            # authentication, otherwise the server could pick "no authentication" and
+            # interpret our authentication request as the CONNECT request.
+            if self._auth_payload is not None:
+                parts = [_GREETING_AUTH_ONLY, self._auth_payload, self._build_connect_request()]
+            else:
+                parts = [_GREETING_NOAUTH, self._build_connect_request()]
+            yield commands.SendData(self.tunnel_connection, b"".join(parts))
         else:
-            # Send greeting with no authentication only
-            greeting = bytes([
-                SOCKS5_VERSION,  # SOCKS version 5
-                1,               # Number of methods
-                SOCKS5_METHOD_NO_AUTHENTICATION_REQUIRED  # No authentication required
-            ])
-        yield commands.SendData(self.tunnel_connection, greeting)
+            # Only offer username/password authentication if we have credentials
+            greeting = _GREETING_AUTH if has_credentials else _GREETING_NOAUTH
+            yield commands.SendData(self.tunnel_connection, greeting)
 
     def receive_handshake_data(
         self, data: bytes
     ) -> layer.CommandGenerator[tuple[bool, str | None]]:
         """Handle SOCKS5 handshake data."""
         self.buf += data
-        
-        if self.state == "greet":
-            return (yield from self._handle_greeting())
-        elif self.state == "auth":
-            return (yield from self._handle_authentication())
-        elif self.state == "connect":
-            return (yield from self._handle_connect_response())
-        else:
-            return False, f"Unknown SOCKS5 state: {self.state}"
+
+        if (
+            self.optimistic
+            and self._auth_payload is None
+            and self.state is self._handle_greeting
+            and len(self.buf) > len(_NOAUTH_CONNECT_OK)
+            and self.buf.startswith(_NOAUTH_CONNECT_OK)
+        ):
+            # Common case: greeting and CONNECT reply both succeeded and arrived together.
+            # IP-bound replies have a fixed length, so we can accept them without the state machine.
+            end = _NOAUTH_CONNECT_OK_LEN.get(self.buf[len(_NOAUTH_CONNECT_OK)])
+            if end is not None and len(self.buf) >= end:
+                return (yield from self._finish_handshake(end))
+
+        # With pipelining, several replies may arrive at once: keep going while we make progress.
+        while True:
+            state = self.state
+            done, err = yield from state()
+            if done or err or self.state is state:
+                return done, err
 
     def _handle_greeting(self) -> layer.CommandGenerator[tuple[bool, str | None]]:
         """Handle SOCKS5 greeting response."""
-        if len(self.buf) < 2:
+        if len(self.buf) - self._pos < 2:
             return False, None
 
-        if self.buf[0] != SOCKS5_VERSION:
-            return False, f"Invalid SOCKS version. Expected {SOCKS5_VERSION}, got {self.buf[0]}"
+        ver, method = _HDR2(self.buf, self._pos)
+        if ver != SOCKS5_VERSION:
+            return False, f"Invalid SOCKS version. Expected {SOCKS5_VERSION}, got {ver}"
 
-        method = self.buf[1]
-        
         if method == SOCKS5_METHOD_NO_ACCEPTABLE_METHODS:
+            if self.optimistic and self._auth_payload is not None:
+                return False, (
+                    "SOCKS5 server accepts none of the offered authentication methods. "
+                    "Only username/password authentication was offered, not no authentication, "
+                    "because socks5_optimistic_handshake is enabled. "
+                    "Disable it for servers that don't support username/password authentication."
+                )
             return False, "SOCKS5 server requires authentication, but we don't support it"
 
         if method == SOCKS5_METHOD_USER_PASSWORD_AUTHENTICATION:
             if not self.username or not self.password:
                 return False, "SOCKS5 server requires authentication, but no credentials provided"
-            
-            # Remove greeting response and send authentication
-            self.buf = self.buf[2:]
-            yield from self._send_authentication()
-            self.state = "auth"
+            if self._auth_payload is None:
+                return False, "SOCKS5 username and password must not exceed 255 bytes"
+
+            # Consume greeting response and send authentication
+            self._pos += 2
+            if not self.optimistic:
+                yield commands.SendData(self.tunnel_connection, self._auth_payload)
+            self.state = self._handle_authentication
             return False, None
         elif method == SOCKS5_METHOD_NO_AUTHENTICATION_REQUIRED:
+            if self.optimistic and self.username and self.password:
+                # We already sent our authentication request, which the server would now misread.
+                return False, "SOCKS5 server selected no authentication, but only username/password was offered"
             # Greeting successful, send connect request
-            self.buf = self.buf[2:]  # Remove greeting response
-            yield from self._send_connect_request()
-            self.state = "connect"
+            self._pos += 2  # Consume greeting response
+            if not self.optimistic:
+                yield commands.SendData(self.tunnel_connection, self._build_connect_request())
+            self.state = self._handle_connect_response
             return False, None
         else:
             return False, f"Unsupported SOCKS5 authentication method: {method}"
 
-    def _send_authentication(self) -> layer.CommandGenerator[None]:
-        """Send SOCKS5 username/password authentication."""
-        assert self.username and self.password
-        
-        # Build authentication request: version(1) + username_len(1) + username + password_len(1) + password
-        username_bytes = self.username.encode('utf-8')
-        password_bytes = self.password.encode('utf-8')
-        
-        auth_request = bytearray([
-            0x01,  # Authentication subnegotiation version
-            len(username_bytes),  # Username length
-        ])
-        auth_request.extend(username_bytes)  # Username
-        auth_request.extend([
-            len(password_bytes),  # Password length
-        ])
-        auth_request.extend(password_bytes)  # Password
-        
-        yield commands.SendData(self.tunnel_connection, bytes(auth_request))
-
     def _handle_authentication(self) -> layer.CommandGenerator[tuple[bool, str | None]]:
         """Handle SOCKS5 authentication response."""
-        if len(self.buf) < 2:
+        if len(self.buf) - self._pos < 2:
             return False, None
 
-        if self.buf[0] != 0x01:
-            return False, f"Invalid authentication subnegotiation version. Expected 0x01, got {self.buf[0]}"
+        ver, status = _HDR2(self.buf, self._pos)
+        if ver != 0x01:
+            return False, f"Invalid authentication subnegotiation version. Expected 0x01, got {ver}"
 
-        status = self.buf[1]
         if status != 0x00:
             return False, f"SOCKS5 authentication failed with status: {status}"
 
         # Authentication successful, send connect request
-        self.buf = self.buf[2:]  # Remove authentication response
-        yield from self._send_connect_request()
-        self.state = "connect"
+        self._pos += 2  # Consume authentication response
+        if not self.optimistic:
+            yield commands.SendData(self.tunnel_connection, self._build_connect_request())
+        self.state = self._handle_connect_response
         return False, None
 
-    def _send_connect_request(self) -> layer.CommandGenerator[None]:
-        """Send SOCKS5 CONNECT request."""
+    def _build_connect_request(self) -> bytes:
+        """Build the SOCKS5 CONNECT request."""
         assert self.conn.address
         host, port = self.conn.address
         
-        # Build SOCKS5 CONNECT request
-        request = bytearray([
-            SOCKS5_VERSION,      # SOCKS version 5
-            SOCKS5_CMD_CONNECT,  # CONNECT command
-            0x00,                # Reserved
-        ])
-        
-        # Add address
-        try:
-            # Try to parse as IP address first
-            ip = socket.inet_pton(socket.AF_INET, host)
-            request.extend([
-                SOCKS5_ATYP_IPV4_ADDRESS,  # IPv4 address type
-                *ip,                       # 4 bytes IPv4 address
-            ])
-        except OSError:
-            try:
-                # Try IPv6
-                ip = socket.inet_pton(socket.AF_INET6, host)
-                request.extend([
-                    SOCKS5_ATYP_IPV6_ADDRESS,  # IPv6 address type
-                    *ip,                        # 16 bytes IPv6 address
-                ])
-            except OSError:
-                # Treat as domain name
-                host_bytes = host.encode('ascii')
-                request.extend([
-                    SOCKS5_ATYP_DOMAINNAME,  # Domain name address type
-                    len(host_bytes),         # Domain name length
-                    *host_bytes,             # Domain name
-                ])
-        
-        # Add port (big-endian)
-        request.extend(struct.pack('!H', port))
-        
-        yield commands.SendData(self.tunnel_connection, bytes(request))
+        atyp, addr = _encode_address(host)
+        if atyp == SOCKS5_ATYP_DOMAINNAME:
+            address = struct.pack("!BB", atyp, len(addr)) + addr
+        else:
+            address = bytes((atyp,)) + addr
+        return b"".join((_CONNECT_PREFIX, address, port.to_bytes(2, "big")))
 
     def _handle_connect_response(self) -> layer.CommandGenerator[tuple[bool, str | None]]:
         """Handle SOCKS5 CONNECT response."""
-        if len(self.buf) < 4:
-            return False, None
+        available = len(self.buf) - self._pos
+        total_len = self._connect_need
+        if total_len is None:
+            if available < 4:
+                return False, None
 
-        if self.buf[0] != SOCKS5_VERSION:
-            return False, f"Invalid SOCKS version in response. Expected {SOCKS5_VERSION}, got {self.buf[0]}"
+            # Reply layout: VER | REP | RSV | ATYP | BND.ADDR | BND.PORT
+            if not self.buf.startswith(_CONNECT_REPLY_OK, self._pos):
+                return False, self._connect_reply_error()
+            atyp = self.buf[self._pos + 3]
+
+            # Parse address and port from response (we need to skip them)
+            if atyp == SOCKS5_ATYP_IPV4_ADDRESS:
+                addr_len = 4
+            elif atyp == SOCKS5_ATYP_IPV6_ADDRESS:
+                addr_len = 16
+            elif atyp == SOCKS5_ATYP_DOMAINNAME:
+                if available < 5:
+                    return False, None
+                addr_len = 1 + self.buf[self._pos + 4]  # length byte + domain name
+            else:
+                return False, f"Unsupported address type in SOCKS5 response: {atyp}"
+
+            # Total response length: version(1) + reply(1) + reserved(1) + atyp(1) + addr_len + port(2)
+            total_len = self._connect_need = 4 + addr_len + 2
+
+        if available < total_len:
+            return False, None
 
-        if self.buf[1] != SOCKS5_CMD_CONNECT:
-            return False, f"Unexpected SOCKS5 command in response. Expected {SOCKS5_CMD_CONNECT}, got {self.buf[1]}"
+        return (yield from self._finish_handshake(self._pos + total_len))
 
-        if self.buf[2] != 0x00:
-            return False, f"Invalid reserved byte in SOCKS5 response: {self.buf[2]}"
+    def _connect_reply_error(self) -> str:
+        """Describe why the CONNECT reply header is not a success header."""
+        ver, reply_code, rsv, _ = _HDR4(self.buf, self._pos)
+        if ver != SOCKS5_VERSION:
+            return f"Invalid SOCKS version in response. Expected {SOCKS5_VERSION}, got {ver}"
 
-        reply_code = self.buf[3]
         if reply_code != SOCKS5_REP_SUCCEEDED:
             error_msg = self._get_socks5_error_message(reply_code)
             proxyaddr = human.format_address(self.tunnel_connection.address)
-            return False, f"SOCKS5 proxy {proxyaddr} refused connection: {error_msg}"
+            return f"SOCKS5 proxy {proxyaddr} refused connection: {error_msg}"
 
-        # Parse address and port from response (we need to skip them)
-        atyp = self.buf[4]
-        addr_len = 0
-        
-        if atyp == SOCKS5_ATYP_IPV4_ADDRESS:
-            addr_len = 4
-        elif atyp == SOCKS5_ATYP_IPV6_ADDRESS:
-            addr_len = 16
-        elif atyp == SOCKS5_ATYP_DOMAINNAME:
-            if len(self.buf) < 5:
-                return False, None
-            addr_len = self.buf[5]
-        else:
-            return False, f"Unsupported address type in SOCKS5 response: {atyp}"
-
-        # Total response length: version(1) + reply(1) + reserved(1) + atyp(1) + addr_len + port(2)
-        total_len = 4 + 1 + addr_len + 2
-        if atyp == SOCKS5_ATYP_DOMAINNAME:
-            total_len += 1  # Add domain name length byte
-
-        if len(self.buf) < total_len:
-            return False, None
+        return f"Invalid reserved byte in SOCKS5 response: {rsv}"
 
-        # Remove the response from buffer and forward any remaining data
-        self.buf = self.buf[total_len:]
-        if self.buf:
-            yield from self.receive_data(self.buf)
-            self.buf = b""
+    def _finish_handshake(self, end: int) -> layer.CommandGenerator[tuple[bool, str | None]]:
+        """Drop the handshake buffer up to `end` and forward any remaining data."""
+        remaining = bytes(self.buf[end:])
+        self.buf.clear()
+        self._pos = 0
+        if remaining:
+            yield from self.receive_data(remaining)
 
         return True, None
 
     def _get_socks5_error_message(self, reply_code: int) -> str:
         """Get human-readable error message for SOCKS5 reply code."""
-        error_messages = {
-            SOCKS5_REP_SUCCEEDED: "Succeeded",
-            SOCKS5_REP_GENERAL_FAILURE: "General failure",
-            SOCKS5_REP_CONNECTION_NOT_ALLOWED: "Connection not allowed",
-            SOCKS5_REP_NETWORK_UNREACHABLE: "Network unreachable",
-            SOCKS5_REP_HOST_UNREACHABLE: "Host unreachable",
-            SOCKS5_REP_CONNECTION_REFUSED: "Connection refused",
-            SOCKS5_REP_TTL_EXPIRED: "TTL expired",
-            SOCKS5_REP_COMMAND_NOT_SUPPORTED: "Command not supported",
-            SOCKS5_REP_ADDRESS_TYPE_NOT_SUPPORTED: "Address type not supported",
-        }
-        return error_messages.get(reply_code, f"Unknown error code: {reply_code}") 
\ No newline at end of file
+        if reply_code < len(_SOCKS5_REP_MESSAGES):
+            return _SOCKS5_REP_MESSAGES[reply_code]
+        return f"Unknown error code: {reply_code}"
@@ -1,39 +1,95 @@
+import json
+import os
+import shutil
+import socket
 import subprocess
+import tempfile
 import time
-import requests
-import os
-import signal
-import json
-import sys
-import websocket
-import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+requests = pytest.importorskip("requests")
+import urllib3  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# Connecting to the local proxy is instant; reading may have to wait for two upstream hops
+CONNECT_TIMEOUT, READ_TIMEOUT = 1.0, 10.0
+
+# Resolved once, relative to the directory the test is started from (the repository root)
+MITMDUMP = os.path.abspath(".venv/bin/mitmdump")
+CONFIG_DIR = os.path.abspath("test/integration/config")
+SOCKS5_CONFIG = os.path.join(CONFIG_DIR, "proxies_socks5.yaml")
+assert os.path.isfile(SOCKS5_CONFIG), SOCKS5_CONFIG
+
+
+@pytest.fixture(autouse=True)
+def _require_mitmdump_and_network():
+    """The suites start a real mitmdump and go through public upstream proxies; skip them without either."""
+    if not os.access(MITMDUMP, os.X_OK):
+        pytest.skip(f"{MITMDUMP} not found")
+    try:
+        socket.create_connection(("httpbin.org", 80), timeout=CONNECT_TIMEOUT).close()
+    except OSError:
+        pytest.skip("no network access")
+
+
+def test_multiupstream_integration():
+    assert run_multiupstream_integration()
+
+
+def test_socks5_multiupstream_integration():
+    assert run_socks5_multiupstream_integration()
 
-def start_mitmproxy(config_dir, port):
+
+def start_mitmproxy(config_dir, port, host="127.0.0.1", log=print):
     cmd = [
-        ".venv/bin/mitmdump",
+        MITMDUMP,
         "--mode", f"multiupstream:{config_dir}",
         "--listen-port", str(port),
         "--set", "termlog_verbosity=error",
         "--set", "console_eventlog_verbosity=error",
     ]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    
-    # Wait a bit and check if process is still running
-    time.sleep(2)
-    if process.poll() is not None:
-        # Process has exited, get the output
-        stdout, stderr = process.communicate()
-        print(f"❌ mitmproxy failed to start:")
-        print(f"   stdout: {stdout}")
-        print(f"   stderr: {stderr}")
-        raise Exception("mitmproxy failed to start")
-    
-    print(f"✅ mitmproxy started successfully on port {port}")
+    # Nobody reads mitmdump's output while the tests run, so don't give it a pipe that can fill up.
+    # stderr goes to an unbounded temporary file instead, so that startup failures can still be reported.
+    # mitmdump keeps its own descriptor, so ours is only needed until the proxy is up.
+    with tempfile.TemporaryFile() as stderr_log:
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=stderr_log)
+
+        # Wait until the proxy accepts connections, or give up if the process dies
+        deadline = time.monotonic() + 10
+        delay = 0.02
+        while not check_proxy_connection(host, port, timeout=0.1, log=log):
+            if process.poll() is not None:
+                # Process has exited, get the output
+                stderr_log.seek(0)
+                stderr = stderr_log.read().decode(errors="replace")
+                log(f"❌ mitmproxy failed to start:")
+                log(f"   stderr: {stderr}")
+                raise Exception("mitmproxy failed to start")
+            if time.monotonic() > deadline:
+                process.kill()
+                process.wait()
+                raise Exception(f"mitmproxy is not listening on {host}:{port}")
+            time.sleep(delay)
+            delay = min(delay * 1.5, 0.2)
+
+    log(f"✅ mitmproxy started successfully and is listening on {host}:{port}")
     return process
 
-def check_proxy_connection(host, port, timeout=5):
+def stop_mitmproxy(process, timeout=2):
+    """Terminate mitmdump, and kill it if it doesn't exit within `timeout` seconds."""
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait(timeout=1)
+
+def check_proxy_connection(host, port, timeout=0.5, log=print):
     """Check if proxy is listening and accepting connections."""
-    import socket
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(timeout)
@@ -41,17 +97,55 @@ def check_proxy_connection(host, port, timeout=5):
         sock.close()
         return result == 0
     except Exception as e:
-        print(f"   ❌ Proxy connection check failed: {e}")
+        log(f"   ❌ Proxy connection check failed: {e}")
         return False
 
-def test_http_load_balancing(proxy_port):
-    """Test HTTP load balancing across multiple upstream proxies."""
-    print("🌐 Testing HTTP load balancing...")
-    
-    proxies = {
-        "http": f"http://127.0.0.1:{proxy_port}",
-        "https": f"http://127.0.0.1:{proxy_port}",
+def make_session(proxy_host, proxy_port):
+    """Create a session that sends everything through the proxy and keeps connections alive."""
+    session = requests.Session()
+    # pool_block makes concurrent requests wait for a pooled connection instead of opening (and later
+    # discarding) extra ones, so each upstream tunnel is negotiated once and then kept alive.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, pool_block=True, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # mitmproxy re-signs HTTPS with its own CA, which the test doesn't install
+    session.verify = False
+    session.proxies = {
+        "http": f"http://{proxy_host}:{proxy_port}",
+        "https": f"http://{proxy_host}:{proxy_port}",
     }
+    return session
+
+def fetch_all(session, urls):
+    """Request all URLs concurrently; returns a (response, error) pair per URL, in order."""
+    def fetch(url):
+        try:
+            return session.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True), None
+        except Exception as e:
+            return None, e
+    
+    with ThreadPoolExecutor(max_workers=len(urls)) as ex:
+        return list(ex.map(fetch, urls))
+
+def read_preview(response, limit=256):
+    """Read at most `limit` bytes of the body for diagnostics and drop the rest."""
+    with response:
+        length = response.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) <= limit:
+            # Small enough to read completely, which lets the connection go back to the pool.
+            return response.content
+        return response.raw.read(limit, decode_content=True)
+
+def origin_ip(preview):
+    """Extract the origin IP from an httpbin-style JSON body, if there is one."""
+    try:
+        return json.loads(preview).get('origin')
+    except Exception:
+        return None
+
+def check_http_load_balancing(session, log=print):
+    """Test HTTP load balancing across multiple upstream proxies."""
+    log("🌐 Testing HTTP load balancing...")
     
     # Test multiple requests to see load balancing in action
     test_urls = [
@@ -59,385 +153,240 @@ def test_http_load_balancing(proxy_port):
         "http://httpbin.org/ip"
     ]
     
+    # Issue all requests at once, then report in order
+    results = fetch_all(session, test_urls)
+    
     successful_requests = 0
     total_requests = len(test_urls)
     
-    for i, url in enumerate(test_urls, 1):
-        try:
-            print(f"  Request {i}/{total_requests}: {url}")
-            response = requests.get(url, proxies=proxies, timeout=10, verify=False)
-            print(f"    ✅ Status: {response.status_code}")
-            
-            # Try to get response content for debugging
-            try:
-                content = response.json()
-                if 'origin' in content:
-                    print(f"    📍 Origin IP: {content['origin']}")
-            except:
-                pass
-                
-            successful_requests += 1
+    for i, (url, (response, error)) in enumerate(zip(test_urls, results), 1):
+        log(f"  Request {i}/{total_requests}: {url}")
+        if error is not None:
+            log(f"    ❌ Error: {error}")
+            continue
+        log(f"    ✅ Status: {response.status_code}")
+        
+        # Show the origin IP for debugging, if the service reports one
+        origin = origin_ip(read_preview(response))
+        if origin:
+            log(f"    📍 Origin IP: {origin}")
             
-        except Exception as e:
-            print(f"    ❌ Error: {e}")
+        successful_requests += 1
     
-    print(f"    📊 Success rate: {successful_requests}/{total_requests}")
+    log(f"    📊 Success rate: {successful_requests}/{total_requests}")
     return successful_requests == total_requests
 
-def test_websocket_public_echo(proxy_host, proxy_port):
-    """Test WebSocket proxying via HTTP upgrade request through the proxy."""
-    print("🌐 Testing WebSocket proxying (HTTP upgrade request)...")
+WS_URL = "http://172.236.138.9:8001/mitm_ws"
+WS_HEADERS = {
+    "Connection": "Upgrade",
+    "Upgrade": "websocket",
+    "Sec-WebSocket-Version": "13",
+    "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ==",
+}
+
+def _ws_upgrade(session, ws_url, log=print):
+    """Send a WebSocket upgrade request through the proxy and check that it is accepted."""
+    try:
+        log(f"    🔄 Sending HTTP upgrade request to {ws_url} via proxy {session.proxies['http']}")
+        response = session.get(
+            ws_url,
+            headers=WS_HEADERS,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            stream=True  # Keep connection open
+        )
+    except Exception as e:
+        log(f"    ❌ WebSocket upgrade request failed: {e}")
+        return False
     
-    # Use the local WebSocket service provided by the user
-    ws_url = "http://172.236.138.9:8001/mitm_ws"
+    with response:
+        log(f"    📊 Response status: {response.status_code}")
+        log(f"    📊 Response headers: {dict(response.headers)}")
+        if response.status_code == 101:
+            log(f"    ✅ WebSocket upgrade successful!")
+            return True
+        log(f"    ❌ WebSocket upgrade failed: {response.status_code}")
+        return False
+
+def _verify_routing(session, test_cases, proxy_kind, log=print):
+    """Request each (url, expected_proxy, description) case and report where it should have been routed."""
+    successful_requests = 0
+    total_requests = len(test_cases)
     
-    def test_websocket_upgrade():
-        """Test WebSocket connection via HTTP upgrade request."""
-        print(f"    Testing WebSocket upgrade: {ws_url}")
-        
-        proxies = {
-            "http": f"http://{proxy_host}:{proxy_port}",
-            "https": f"http://{proxy_host}:{proxy_port}",
-        }
-        
-        headers = {
-            "Connection": "Upgrade",
-            "Upgrade": "websocket",
-            "Sec-WebSocket-Version": "13",
-            "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ==",
-        }
+    results = fetch_all(session, [url for url, _, _ in test_cases])
+    
+    for i, ((url, expected_proxy, description), (response, error)) in enumerate(zip(test_cases, results), 1):
+        log(f"  Request {i}/{total_requests}: {description}")
+        log(f"    URL: {url}")
+        log(f"    Expected proxy: {expected_proxy}")
+        if error is not None:
+            log(f"    ❌ Error: {error}")
+            continue
+        log(f"    ✅ Status: {response.status_code}")
         
-        try:
-            print(f"      🔄 Sending HTTP upgrade request to {ws_url} via proxy {proxy_host}:{proxy_port}")
-            response = requests.get(
-                ws_url,
-                proxies=proxies,
-                headers=headers,
-                timeout=10,
-                verify=False,
-                stream=True  # Keep connection open
-            )
-            
-            print(f"      📊 Response status: {response.status_code}")
-            print(f"      📊 Response headers: {dict(response.headers)}")
+        # Show the origin IP or the start of the body for debugging
+        preview = read_preview(response)
+        origin = origin_ip(preview)
+        if origin:
+            log(f"    📍 Origin IP: {origin}")
+        else:
+            log(f"    📍 Response: {preview[:100]!r}...")
             
-            if response.status_code == 101:
-                print(f"      ✅ WebSocket upgrade successful!")
-                # Try to read some data to verify connection
-                try:
-                    # Read a small amount of data to test the connection
-                    data = response.raw.read(1024)
-                    print(f"      📨 Received data: {data[:100]}...")
-                    response.close()
-                    return True
-                except Exception as e:
-                    print(f"      ⚠️  Could not read data: {e}")
-                    response.close()
-                    return True  # Upgrade was successful even if we can't read data
-            else:
-                print(f"      ❌ WebSocket upgrade failed: {response.status_code}")
-                response.close()
-                return False
-                
-        except Exception as e:
-            print(f"      ❌ WebSocket upgrade request failed: {e}")
-            return False
-    
-    # Test WebSocket upgrade
-    print(f"    --- Testing WebSocket Upgrade ---")
-    success = test_websocket_upgrade()
+        successful_requests += 1
+        
+        # Note: In a real scenario, you might want to check the actual proxy used
+        # by examining the response headers or using a service that shows the proxy IP
+        log(f"    🔄 Request routed through {expected_proxy}")
     
-    if success:
-        print(f"      ✅ WebSocket upgrade test PASSED")
-    else:
-        print(f"      ❌ WebSocket upgrade test FAILED")
+    log(f"    📊 Success rate: {successful_requests}/{total_requests}")
+    log(f"    📝 Note: {proxy_kind} routing verification is based on configuration rules.")
+    log(f"    📝 To verify actual proxy usage, check {proxy_kind} server logs or use a service that shows proxy IP.")
     
-    print(f"    📊 WebSocket test summary: {'1/1' if success else '0/1'} services worked")
+    return successful_requests == total_requests
+
+def check_websocket_public_echo(session, log=print):
+    """Test WebSocket proxying via HTTP upgrade request through the proxy."""
+    log("🌐 Testing WebSocket proxying (HTTP upgrade request)...")
+    success = _ws_upgrade(session, WS_URL, log=log)
+    log(f"    📊 WebSocket test summary: {'1/1' if success else '0/1'} services worked")
     return success
 
-def test_proxy_routing_verification(proxy_host, proxy_port):
+def check_proxy_routing_verification(session, log=print):
     """Test that requests are correctly routed to different proxies based on host patterns."""
-    print("🎯 Testing proxy routing verification...")
-    
-    proxies = {
-        "http": f"http://{proxy_host}:{proxy_port}",
-        "https": f"http://{proxy_host}:{proxy_port}",
-    }
+    log("🎯 Testing proxy routing verification...")
     
     # Test URLs that should route to different proxies based on config
     test_cases = [
-        {
-            "url": "http://www.google.com",
-            "expected_proxy": "proxy1",  # Should go to proxy1 (no auth)
-            "description": "Google domain (no auth proxy)"
-        },
-        {
-            "url": "http://www.baidu.com", 
-            "expected_proxy": "proxy2",  # Should go to proxy2 (with auth)
-            "description": "Baidu domain (auth proxy)"
-        },
-        {
-            "url": "http://httpbin.org/ip",
-            "expected_proxy": "proxy1",  # Should go to proxy1 (default rule)
-            "description": "Default domain (no auth proxy)"
-        }
+        ("http://www.google.com", "proxy1", "Google domain (no auth proxy)"),
+        ("http://www.baidu.com", "proxy2", "Baidu domain (auth proxy)"),
+        ("http://httpbin.org/ip", "proxy1", "Default domain (no auth proxy)"),
     ]
-    
-    successful_requests = 0
-    total_requests = len(test_cases)
-    
-    for i, test_case in enumerate(test_cases, 1):
-        try:
-            print(f"  Request {i}/{total_requests}: {test_case['description']}")
-            print(f"    URL: {test_case['url']}")
-            print(f"    Expected proxy: {test_case['expected_proxy']}")
-            
-            response = requests.get(test_case['url'], proxies=proxies, timeout=10, verify=False)
-            print(f"    ✅ Status: {response.status_code}")
-            
-            # Try to get response content for debugging
-            try:
-                content = response.json()
-                if 'origin' in content:
-                    print(f"    📍 Origin IP: {content['origin']}")
-            except:
-                pass
-                
-            successful_requests += 1
-            
-            # Note: In a real scenario, you might want to check the actual proxy used
-            # by examining the response headers or using a service that shows the proxy IP
-            print(f"    🔄 Request routed through {test_case['expected_proxy']}")
-            
-        except Exception as e:
-            print(f"    ❌ Error: {e}")
-    
-    print(f"    📊 Success rate: {successful_requests}/{total_requests}")
-    print(f"    📝 Note: Proxy routing verification is based on configuration rules.")
-    print(f"    📝 To verify actual proxy usage, check proxy server logs or use a service that shows proxy IP.")
-    
-    return successful_requests == total_requests
+    return _verify_routing(session, test_cases, "proxy", log=log)
 
-def test_multiupstream_integration():
-    config_dir = "test/integration/config"
+def run_multiupstream_integration(log=print):
+    config_dir = CONFIG_DIR
     proxy_port = 8083
     proxy_host = "127.0.0.1"
 
-    print("🚀 Starting Multi-Upstream Proxy Integration Test")
-    print(f"📁 Config directory: {config_dir}")
-    print(f"🔌 Proxy port: {proxy_port}")
+    log("🚀 Starting Multi-Upstream Proxy Integration Test")
+    log(f"📁 Config directory: {config_dir}")
+    log(f"🔌 Proxy port: {proxy_port}")
 
     # Start mitmproxy
-    print("🔄 Starting mitmproxy...")
-    mitm = start_mitmproxy(config_dir, proxy_port)
-    
-    # Check if proxy is listening
-    print(f"🔍 Checking if proxy is listening on {proxy_host}:{proxy_port}...")
-    if not check_proxy_connection(proxy_host, proxy_port):
-        print(f"❌ Proxy is not listening on {proxy_host}:{proxy_port}")
-        raise Exception("Proxy failed to start or is not listening")
-    print(f"✅ Proxy is listening and accepting connections")
-    
-    time.sleep(1)
+    log("🔄 Starting mitmproxy...")
+    # start_mitmproxy only returns once the proxy accepts connections
+    mitm = start_mitmproxy(config_dir, proxy_port, proxy_host, log=log)
+    session = make_session(proxy_host, proxy_port)
 
     try:
         # Test HTTP load balancing
-        http_success = test_http_load_balancing(proxy_port)
+        http_success = check_http_load_balancing(session, log=log)
         # Test WebSocket proxying
-        ws_success = test_websocket_public_echo(proxy_host, proxy_port)
+        ws_success = check_websocket_public_echo(session, log=log)
         # Test proxy routing verification
-        routing_success = test_proxy_routing_verification(proxy_host, proxy_port)
+        routing_success = check_proxy_routing_verification(session, log=log)
         
-        print("\n📋 Integration Test Summary:")
-        print(f"  {'✅' if http_success else '❌'} HTTP load balancing: {'Passed' if http_success else 'Failed'}")
-        print(f"  {'✅' if ws_success else '❌'} WebSocket proxying: {'Passed' if ws_success else 'Failed'}")
-        print(f"  {'✅' if routing_success else '❌'} Proxy routing verification: {'Passed' if routing_success else 'Failed'}")
+        log("\n📋 Integration Test Summary:")
+        log(f"  {'✅' if http_success else '❌'} HTTP load balancing: {'Passed' if http_success else 'Failed'}")
+        log(f"  {'✅' if ws_success else '❌'} WebSocket proxying: {'Passed' if ws_success else 'Failed'}")
+        log(f"  {'✅' if routing_success else '❌'} Proxy routing verification: {'Passed' if routing_success else 'Failed'}")
         
         if http_success and ws_success and routing_success:
-            print("  🎉 All tests passed! Multi-upstream proxy is working correctly.")
+            log("  🎉 All tests passed! Multi-upstream proxy is working correctly.")
         else:
-            print("  ⚠️  Some tests failed. Check the configuration and proxy availability.")
+            log("  ⚠️  Some tests failed. Check the configuration and proxy availability.")
         
         return http_success and ws_success and routing_success
         
     except Exception as e:
-        print(f"❌ Integration test failed: {e}")
+        log(f"❌ Integration test failed: {e}")
         return False
     
     finally:
         # Clean up
+        session.close()
         if 'mitm' in locals() and mitm.poll() is None:
-            print("🛑 Stopping mitmproxy...")
-            mitm.terminate()
-            mitm.wait()
+            log("🛑 Stopping mitmproxy...")
+            stop_mitmproxy(mitm)
 
 
-def test_socks5_websocket(proxy_host, proxy_port):
-    print("🌐 Testing WebSocket via socks5 multiupstream...")
-    
-    # Use HTTP upgrade request to test WebSocket through SOCKS5 proxy
-    ws_url = "http://172.236.138.9:8001/mitm_ws"
-    
-    proxies = {
-        "http": f"http://{proxy_host}:{proxy_port}",
-        "https": f"http://{proxy_host}:{proxy_port}",
-    }
-    
-    headers = {
-        "Connection": "Upgrade",
-        "Upgrade": "websocket",
-        "Sec-WebSocket-Version": "13",
-        "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ==",
-    }
-    
-    try:
-        print(f"    🔄 Sending HTTP upgrade request to {ws_url} via SOCKS5 proxy {proxy_host}:{proxy_port}")
-        response = requests.get(
-            ws_url,
-            proxies=proxies,
-            headers=headers,
-            timeout=10,
-            verify=False,
-            stream=True
-        )
-        
-        print(f"    📊 Response status: {response.status_code}")
-        print(f"    📊 Response headers: {dict(response.headers)}")
-        
-        if response.status_code == 101:
-            print(f"    ✅ WebSocket upgrade successful through SOCKS5 proxy!")
-            response.close()
-            return True
-        else:
-            print(f"    ❌ WebSocket upgrade failed: {response.status_code}")
-            response.close()
-            return False
-            
-    except Exception as e:
-        print(f"    ❌ WebSocket upgrade request failed: {e}")
-        return False
+def check_socks5_websocket(session, log=print):
+    log("🌐 Testing WebSocket via socks5 multiupstream...")
+    return _ws_upgrade(session, WS_URL, log=log)
 
-def test_socks5_proxy_routing_verification(proxy_host, proxy_port):
+def check_socks5_proxy_routing_verification(session, log=print):
     """Test that SOCKS5 requests are correctly routed to different proxies with auth and no-auth."""
-    print("🎯 Testing SOCKS5 proxy routing verification...")
-    
-    proxies = {
-        "http": f"http://{proxy_host}:{proxy_port}",
-        "https": f"http://{proxy_host}:{proxy_port}",
-    }
+    log("🎯 Testing SOCKS5 proxy routing verification...")
     
     # Test URLs that should route to different SOCKS5 proxies based on config
     test_cases = [
-        {
-            "url": "http://www.google.com",
-            "expected_proxy": "socks5-proxy-auth",  # Should go to auth proxy
-            "description": "Google domain (auth SOCKS5 proxy)"
-        },
-        {
-            "url": "http://www.baidu.com", 
-            "expected_proxy": "socks5-proxy-noauth",  # Should go to no-auth proxy
-            "description": "Baidu domain (no-auth SOCKS5 proxy)"
-        },
-        {
-            "url": "http://httpbin.org/ip",
-            "expected_proxy": "socks5-proxy-auth",  # Should go to auth proxy (default rule)
-            "description": "Default domain (auth SOCKS5 proxy)"
-        }
+        ("http://www.google.com", "socks5-proxy-auth", "Google domain (auth SOCKS5 proxy)"),
+        ("http://www.baidu.com", "socks5-proxy-noauth", "Baidu domain (no-auth SOCKS5 proxy)"),
+        ("http://httpbin.org/ip", "socks5-proxy-auth", "Default domain (auth SOCKS5 proxy)"),
     ]
-    
-    successful_requests = 0
-    total_requests = len(test_cases)
-    
-    for i, test_case in enumerate(test_cases, 1):
-        try:
-            print(f"  Request {i}/{total_requests}: {test_case['description']}")
-            print(f"    URL: {test_case['url']}")
-            print(f"    Expected proxy: {test_case['expected_proxy']}")
-            
-            response = requests.get(test_case['url'], proxies=proxies, timeout=10, verify=False)
-            print(f"    ✅ Status: {response.status_code}")
-            
-            # Try to get response content for debugging
-            try:
-                content = response.json()
-                if 'origin' in content:
-                    print(f"    📍 Origin IP: {content['origin']}")
-            except:
-                print(f"    📍 Response: {response.text[:100]}...")
-                
-            successful_requests += 1
-            
-            # Note: In a real scenario, you might want to check the actual proxy used
-            # by examining the response headers or using a service that shows the proxy IP
-            print(f"    🔄 Request routed through {test_case['expected_proxy']}")
-            
-        except Exception as e:
-            print(f"    ❌ Error: {e}")
-    
-    print(f"    📊 Success rate: {successful_requests}/{total_requests}")
-    print(f"    📝 Note: SOCKS5 proxy routing verification is based on configuration rules.")
-    print(f"    📝 To verify actual proxy usage, check SOCKS5 server logs or use a service that shows proxy IP.")
-    
-    return successful_requests == total_requests
+    return _verify_routing(session, test_cases, "SOCKS5 proxy", log=log)
 
 # 修改 socks5 集成测试流程，串联 WebSocket 测试
-def test_socks5_multiupstream_integration():
-    socks5_config = "test/integration/config/proxies_socks5.yaml"
+def run_socks5_multiupstream_integration(log=print):
+    socks5_config = SOCKS5_CONFIG
     proxy_port = 8091
     proxy_host = "127.0.0.1"
-    print("\n🚀 Starting socks5 multiupstream integration test")
-    print(f"📁 Config: {socks5_config}")
-    print(f"🔌 Proxy port: {proxy_port}")
-
-    mitm = start_mitmproxy(os.path.dirname(socks5_config), proxy_port)
-    print(f"🔍 Checking if proxy is listening on {proxy_host}:{proxy_port}...")
-    if not check_proxy_connection(proxy_host, proxy_port):
-        print(f"❌ Proxy is not listening on {proxy_host}:{proxy_port}")
-        mitm.terminate()
-        mitm.wait()
-        return False
-    print(f"✅ Proxy is listening and accepting connections")
-    time.sleep(1)
-    try:
-        # Test HTTP via SOCKS5
-        proxies = {
-            "http": f"http://{proxy_host}:{proxy_port}",
-            "https": f"http://{proxy_host}:{proxy_port}",
-        }
-        test_url = "http://myip.ipip.net"
-        print("🌐 Testing HTTP via socks5 multiupstream...")
-        response = requests.get(test_url, proxies=proxies, timeout=10, verify=False)
-        print(f"    ✅ Status: {response.status_code}")
-        print(f"    📍 Response: {response.text[:100]}...")
+    log("\n🚀 Starting socks5 multiupstream integration test")
+    log(f"📁 Config: {socks5_config}")
+    log(f"🔌 Proxy port: {proxy_port}")
+
+    # The loader prefers proxies.yaml, so the SOCKS5 config gets a directory of its own
+    with tempfile.TemporaryDirectory() as socks5_config_dir:
+        shutil.copy(socks5_config, socks5_config_dir)
+
+        # start_mitmproxy only returns once the proxy accepts connections
+        mitm = start_mitmproxy(socks5_config_dir, proxy_port, proxy_host, log=log)
+        session = make_session(proxy_host, proxy_port)
+        try:
+            # Test HTTP via SOCKS5
+            test_url = "http://myip.ipip.net"
+            log("🌐 Testing HTTP via socks5 multiupstream...")
+            response = session.get(test_url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True)
+            log(f"    ✅ Status: {response.status_code}")
+            log(f"    📍 Response: {read_preview(response)[:100]!r}...")
         
-        # Test WebSocket via SOCKS5
-        ws_success = test_socks5_websocket(proxy_host, proxy_port)
+            # Test WebSocket via SOCKS5
+            ws_success = check_socks5_websocket(session, log=log)
         
-        # Test SOCKS5 proxy routing verification
-        routing_success = test_socks5_proxy_routing_verification(proxy_host, proxy_port)
+            # Test SOCKS5 proxy routing verification
+            routing_success = check_socks5_proxy_routing_verification(session, log=log)
         
-        print("\n📋 SOCKS5 Integration Test Summary:")
-        print(f"  {'✅' if response.status_code == 200 else '❌'} HTTP via SOCKS5: {'Passed' if response.status_code == 200 else 'Failed'}")
-        print(f"  {'✅' if ws_success else '❌'} WebSocket via SOCKS5: {'Passed' if ws_success else 'Failed'}")
-        print(f"  {'✅' if routing_success else '❌'} SOCKS5 proxy routing: {'Passed' if routing_success else 'Failed'}")
+            log("\n📋 SOCKS5 Integration Test Summary:")
+            log(f"  {'✅' if response.status_code == 200 else '❌'} HTTP via SOCKS5: {'Passed' if response.status_code == 200 else 'Failed'}")
+            log(f"  {'✅' if ws_success else '❌'} WebSocket via SOCKS5: {'Passed' if ws_success else 'Failed'}")
+            log(f"  {'✅' if routing_success else '❌'} SOCKS5 proxy routing: {'Passed' if routing_success else 'Failed'}")
         
-        if response.status_code == 200 and ws_success and routing_success:
-            print("  🎉 All SOCKS5 tests passed! Multi-upstream SOCKS5 proxy is working correctly.")
-        else:
-            print("  ⚠️  Some SOCKS5 tests failed. Check the configuration and proxy availability.")
+            if response.status_code == 200 and ws_success and routing_success:
+                log("  🎉 All SOCKS5 tests passed! Multi-upstream SOCKS5 proxy is working correctly.")
+            else:
+                log("  ⚠️  Some SOCKS5 tests failed. Check the configuration and proxy availability.")
         
-        return response.status_code == 200 and ws_success and routing_success
-    except Exception as e:
-        print(f"    ❌ Error: {e}")
-        print("❌ socks5 multiupstream integration test FAILED")
-        return False
-    finally:
-        if mitm.poll() is None:
-            print("🛑 Stopping mitmproxy...")
-            mitm.terminate()
-            mitm.wait()
+            return response.status_code == 200 and ws_success and routing_success
+        except Exception as e:
+            log(f"    ❌ Error: {e}")
+            log("❌ socks5 multiupstream integration test FAILED")
+            return False
+        finally:
+            session.close()
+            if mitm.poll() is None:
+                log("🛑 Stopping mitmproxy...")
+                stop_mitmproxy(mitm)
+
+def run_buffered(suite):
+    """Run `suite`, collecting what it logs instead of printing it."""
+    lines = []
+    return suite(log=lines.append), lines
 
 if __name__ == "__main__":
-    success = test_multiupstream_integration()
-    socks5_success = test_socks5_multiupstream_integration()
-    exit(0 if (success and socks5_success) else 1) 
\ No newline at end of file
+    # The suites use different ports and config dirs, so they can run side by side.
+    # Each one logs into its own list, and the output is printed one suite after the other once both are done.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f1 = ex.submit(run_buffered, run_multiupstream_integration)
+        f2 = ex.submit(run_buffered, run_socks5_multiupstream_integration)
+        (success, lines), (socks5_success, socks5_lines) = f1.result(), f2.result()
+    print("\n".join(lines + socks5_lines))
+    exit(0 if (success and socks5_success) else 1)
@@ -0,0 +1,274 @@
+import pytest
+
+from mitmproxy.connection import ConnectionState
+from mitmproxy.connection import Server
+from mitmproxy.proxy import layer
+from mitmproxy.proxy.commands import CloseConnection
+from mitmproxy.proxy.commands import Log
+from mitmproxy.proxy.commands import SendData
+from mitmproxy.proxy.context import Context
+from mitmproxy.proxy.events import DataReceived
+from mitmproxy.proxy.events import Event
+from mitmproxy.proxy.events import Start
+from mitmproxy.proxy.layers.http._socks5_upstream_proxy import _encode_address
+from mitmproxy.proxy.layers.http._socks5_upstream_proxy import Socks5UpstreamProxy
+from test.mitmproxy.proxy.tutils import Playbook
+
+CONNECT_REPLY_IPV4 = b"\x05\x00\x00\x01\x7f\x00\x00\x01\x04\x38"
+
+
+class TChildLayer(layer.Layer):
+    def _handle_event(self, event: Event) -> layer.CommandGenerator[None]:
+        if isinstance(event, Start):
+            yield Log(f"Got start. Server state: {self.context.server.state.name}")
+        elif isinstance(event, DataReceived):
+            yield Log(f"Got data: {event.data!r}")
+
+
+def _socks5_layer(
+    tctx: Context,
+    address=("example.com", 443),
+    username=None,
+    password=None,
+    optimistic=False,
+) -> tuple[Socks5UpstreamProxy, Server]:
+    tctx.options.socks5_optimistic_handshake = optimistic
+    tctx.server.address = address
+    proxy = Server(address=("proxy", 1080))
+    proxy.state = ConnectionState.OPEN
+    socks5 = Socks5UpstreamProxy(tctx, proxy, username, password)
+    socks5.child_layer = TChildLayer(tctx)
+    return socks5, proxy
+
+
+def _handshake_result(gen) -> tuple[bool, str | None]:
+    """Run a receive_handshake_data generator to completion and return its (done, err) result."""
+    with pytest.raises(StopIteration) as e:
+        while True:
+            next(gen)
+    return e.value.value
+
+
+@pytest.mark.parametrize(
+    "address, connect_request",
+    [
+        (("example.com", 443), b"\x05\x01\x00\x03\x0bexample.com\x01\xbb"),
+        (("127.0.0.1", 80), b"\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50"),
+        (("::1", 80), b"\x05\x01\x00\x04" + b"\x00" * 15 + b"\x01\x00\x50"),
+    ],
+)
+def test_no_auth(tctx: Context, address, connect_request):
+    socks5, proxy = _socks5_layer(tctx, address)
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x01\x00")
+        >> DataReceived(proxy, b"\x05\x00")
+        << SendData(proxy, connect_request)
+        >> DataReceived(proxy, CONNECT_REPLY_IPV4)
+        << Log("Got start. Server state: OPEN")
+    )
+
+
+def test_user_password_auth(tctx: Context):
+    socks5, proxy = _socks5_layer(tctx, username="user", password="pass")
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x02\x00\x02")
+        >> DataReceived(proxy, b"\x05\x02")
+        << SendData(proxy, b"\x01\x04user\x04pass")
+        >> DataReceived(proxy, b"\x01\x00")
+        << SendData(proxy, b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        >> DataReceived(proxy, CONNECT_REPLY_IPV4)
+        << Log("Got start. Server state: OPEN")
+    )
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        CONNECT_REPLY_IPV4,
+        b"\x05\x00\x00\x03\x05proxy\x04\x38",
+        b"\x05\x00\x00\x04" + b"\x00" * 16 + b"\x04\x38",
+    ],
+)
+def test_connect_reply_split(tctx: Context, reply):
+    """The connect reply may arrive in pieces, possibly followed by tunneled data."""
+    socks5, proxy = _socks5_layer(tctx)
+    playbook = (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x01\x00")
+        >> DataReceived(proxy, b"\x05\x00")
+        << SendData(proxy, b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+    )
+    for i in range(len(reply) - 1):
+        playbook >> DataReceived(proxy, reply[i : i + 1])
+    assert (
+        playbook
+        >> DataReceived(proxy, reply[-1:] + b"hello")
+        << Log("Got start. Server state: OPEN")
+        << Log("Got data: b'hello'")
+    )
+
+
+@pytest.mark.parametrize(
+    "greeting_reply, connect_reply, err",
+    [
+        (b"\x04\x00", None, "Invalid SOCKS version. Expected 5, got 4"),
+        (b"\x05\xff", None, "SOCKS5 server requires authentication, but we don't support it"),
+        (b"\x05\x02", None, "SOCKS5 server requires authentication, but no credentials provided"),
+        (b"\x05\x00", b"\x05\x05\x00\x01", "SOCKS5 proxy proxy:1080 refused connection: Connection refused"),
+        (b"\x05\x00", b"\x05\x09\x00\x01", "SOCKS5 proxy proxy:1080 refused connection: Unknown error code: 9"),
+        (b"\x05\x00", b"\x05\x00\x00\x07", "Unsupported address type in SOCKS5 response: 7"),
+        (b"\x05\x00", b"\x04\x00\x00\x01", "Invalid SOCKS version in response. Expected 5, got 4"),
+        (b"\x05\x00", b"\x05\x00\x01\x01", "Invalid reserved byte in SOCKS5 response: 1"),
+    ],
+)
+def test_handshake_error(tctx: Context, greeting_reply, connect_reply, err):
+    socks5, proxy = _socks5_layer(tctx)
+    playbook = (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x01\x00")
+        >> DataReceived(proxy, greeting_reply)
+    )
+    if connect_reply:
+        playbook << SendData(proxy, b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        playbook >> DataReceived(proxy, connect_reply)
+    assert (
+        playbook
+        << CloseConnection(proxy)
+        << Log("Got start. Server state: CLOSED")
+    )
+
+    # The playbook doesn't expose the error, so take it from a fresh handshake directly.
+    socks5, _ = _socks5_layer(tctx)
+    done, msg = _handshake_result(socks5.receive_handshake_data(greeting_reply))
+    if connect_reply:
+        assert (done, msg) == (False, None)
+        done, msg = _handshake_result(socks5.receive_handshake_data(connect_reply))
+    assert not done
+    assert msg == err
+
+
+def test_optimistic_no_auth(tctx: Context):
+    socks5, proxy = _socks5_layer(tctx, optimistic=True)
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x01\x00\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        >> DataReceived(proxy, b"\x05\x00")
+        >> DataReceived(proxy, CONNECT_REPLY_IPV4 + b"hello")
+        << Log("Got start. Server state: OPEN")
+        << Log("Got data: b'hello'")
+    )
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        CONNECT_REPLY_IPV4,
+        b"\x05\x00\x00\x04" + b"\x00" * 16 + b"\x04\x38",
+        b"\x05\x00\x00\x03\x05proxy\x04\x38",
+    ],
+)
+def test_optimistic_no_auth_single_chunk(tctx: Context, reply):
+    socks5, proxy = _socks5_layer(tctx, optimistic=True)
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x01\x00\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+        >> DataReceived(proxy, b"\x05\x00" + reply + b"hello")
+        << Log("Got start. Server state: OPEN")
+        << Log("Got data: b'hello'")
+    )
+
+
+def test_optimistic_user_password_auth(tctx: Context):
+    """All replies to the pipelined handshake may arrive in a single chunk."""
+    socks5, proxy = _socks5_layer(
+        tctx, username="user", password="pass", optimistic=True
+    )
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(
+            proxy,
+            b"\x05\x01\x02"
+            b"\x01\x04user\x04pass"
+            b"\x05\x01\x00\x03\x0bexample.com\x01\xbb",
+        )
+        >> DataReceived(proxy, b"\x05\x02\x01\x00" + CONNECT_REPLY_IPV4)
+        << Log("Got start. Server state: OPEN")
+    )
+
+
+def test_optimistic_unexpected_method(tctx: Context):
+    socks5, proxy = _socks5_layer(
+        tctx, username="user", password="pass", optimistic=True
+    )
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(
+            proxy,
+            b"\x05\x01\x02"
+            b"\x01\x04user\x04pass"
+            b"\x05\x01\x00\x03\x0bexample.com\x01\xbb",
+        )
+        >> DataReceived(proxy, b"\x05\x00")
+        << CloseConnection(proxy)
+        << Log("Got start. Server state: CLOSED")
+    )
+
+
+@pytest.mark.parametrize(
+    "host, expected",
+    [
+        ("example.com", (0x03, b"example.com")),
+        ("1.example.com", (0x03, b"1.example.com")),
+        ("example.1", (0x03, b"example.1")),
+        ("1.2.3", (0x03, b"1.2.3")),
+        ("10.0.0.1", (0x01, b"\x0a\x00\x00\x01")),
+        ("::1", (0x04, b"\x00" * 15 + b"\x01")),
+    ],
+)
+def test_encode_address(host, expected):
+    assert _encode_address(host) == expected
+
+
+@pytest.mark.parametrize("optimistic", [True, False])
+def test_credentials_too_long(tctx: Context, optimistic):
+    socks5, proxy = _socks5_layer(
+        tctx, username="u" * 256, password="pass", optimistic=optimistic
+    )
+    assert (
+        Playbook(socks5, logs=True)
+        << SendData(proxy, b"\x05\x02\x00\x02")
+        >> DataReceived(proxy, b"\x05\x02")
+        << CloseConnection(proxy)
+        << Log("Got start. Server state: CLOSED")
+    )
+
+
+@pytest.mark.parametrize(
+    "optimistic, err",
+    [
+        (True, "Only username/password authentication was offered, not no authentication"),
+        (False, "SOCKS5 server requires authentication, but we don't support it"),
+    ],
+)
+def test_no_acceptable_methods_with_credentials(tctx: Context, optimistic, err):
+    """A server that only supports no authentication rejects the optimistic auth-only offer."""
+    socks5, proxy = _socks5_layer(
+        tctx, username="user", password="pass", optimistic=optimistic
+    )
+    gen = socks5.receive_handshake_data(b"\x05\xff")
+    with pytest.raises(StopIteration) as e:
+        next(gen)
+    done, msg = e.value.value
+    assert not done
+    assert err in msg
+    if optimistic:
+        assert "socks5_optimistic_handshake" in msg
+
+
+def test_optimistic_off_by_default(tctx: Context):
+    """Pipelining is opt-in: the default handshake offers no-auth alongside username/password."""
+    tctx.server.address = ("example.com", 443)
+    socks5 = Socks5UpstreamProxy(tctx, Server(address=("proxy", 1080)), "user", "pass")
+    assert not socks5.optimistic
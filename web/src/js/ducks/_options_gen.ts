@@ -70,6 +70,7 @@ export interface OptionsState {
     server_replay_use_headers: string[];
     show_ignored_hosts: boolean;
     showhost: boolean;
+    socks5_optimistic_handshake: boolean;
     ssl_insecure: boolean;
     ssl_verify_upstream_trusted_ca: string | undefined;
     ssl_verify_upstream_trusted_confdir: string | undefined;
@@ -176,6 +177,7 @@ export const defaultState: OptionsState = {
     server_replay_use_headers: [],
     show_ignored_hosts: false,
     showhost: false,
+    socks5_optimistic_handshake: false,
     ssl_insecure: false,
     ssl_verify_upstream_trusted_ca: undefined,
     ssl_verify_upstream_trusted_confdir: undefined,